@@ -1,8 +1,16 @@
+import fnmatch
+import json
 import os
 import re
 import threading
 import webbrowser
 
+from functools import lru_cache
+from typing import NamedTuple
+from urllib.parse import quote
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from os.path import isfile, isdir
 from os.path import abspath, relpath
@@ -33,6 +41,14 @@ error = sublime.error_message
 is_windows = sublime.platform() == 'windows'
 
 
+def unix_style_path(path):
+    return path.replace('\\', '/')
+
+
+def keep_path(path):
+    return path
+
+
 class SideBarQuickFileBrowserCommand(sublime_plugin.WindowCommand):
     def is_visible(self, paths, **args):
         return len(paths) == 1 and os.path.exists(paths[0])
@@ -86,7 +102,8 @@ class WindowQuickFileBrowserInputPathCommand(sublime_plugin.WindowCommand):
 
 class QuickFileBrowserSavePathCommand(sublime_plugin.WindowCommand):
     def run(self, path):
-        QuickPanelFileBrowser.path_list.get(self.window.id(), []).append(path)
+        saved = QuickPanelFileBrowser.path_list.setdefault(self.window.id(), {})
+        saved[path] = None
         sublime.status_message(f'Saved {path}')
 
 
@@ -102,9 +119,72 @@ class QuickFileBrowserOpenFileCommand(sublime_plugin.WindowCommand):
 KIND_FILE = (sublime.KIND_ID_VARIABLE, 'F', "File")
 KIND_DIRECTORY = (sublime.KIND_ID_VARIABLE, 'D', "Directory")
 
+COPY_TAG_PREFIX = f"<em>Copy Path</em>:{2 * '&nbsp;'}"
+INSERT_TAG_PREFIX = f"<em>Insert Path</em>:{2 * '&nbsp;'}"
+
+# Hand-assembled equivalents of sublime.command_url(...): the command
+# name and argument scaffolding are constant, so they are JSON- and
+# URL-encoded once here and only the path varies per call.
+OPEN_URL_PREFIX = 'subl:' + quote('quick_file_browser_open_file {"path": "')
+OPEN_URL_IN_SUBLIME = quote('", "open_in_sublime": true}')
+OPEN_URL_IN_BROWSER = quote('", "open_in_sublime": false}')
+SAVE_URL_PREFIX = 'subl:' + quote('quick_file_browser_save_path {"path": "')
+INSERT_URL_PREFIX = 'subl:' + quote('insert {"characters": "')
+URL_SUFFIX = quote('"}')
+
+NEEDS_JSON_ESCAPE = re.compile(r'[\\"\x00-\x1f]').search
+
+
+@lru_cache(maxsize=4096)
+def quote_path(path):
+    # Every absolute path is quoted for the open, copy and insert links
+    # and every relative path twice more, so the cache turns all but
+    # the first encoding of a path into a dict hit.
+    # Paths almost never contain characters that are special inside a
+    # JSON string, so the json.dumps round-trip is reserved for the
+    # rare ones that do.
+    if NEEDS_JSON_ESCAPE(path):
+        path = json.dumps(path)[1:-1]
+    return quote(path)
+
+
+def path_tags(absolute_url, relative_url):
+    return (f'<a href="{absolute_url}">absolute</a>,{2 * "&nbsp;"}'
+            f'<a href="{relative_url}">relative</a>;')
+
+
+def open_file_url(path, in_sublime):
+    return OPEN_URL_PREFIX + quote_path(path) + (
+        OPEN_URL_IN_SUBLIME if in_sublime else OPEN_URL_IN_BROWSER)
+
+
+def save_path_url(path):
+    return SAVE_URL_PREFIX + quote_path(path) + URL_SUFFIX
+
+
+def insert_path_url(path):
+    return INSERT_URL_PREFIX + quote_path(path) + URL_SUFFIX
+
+
+class RawFile(NamedTuple):
+    """A scanned file before any QuickPanelItem or HTML exists for it.
+
+    scan_tree() produces these by the hundred thousand, so they stay a
+    plain C-level tuple; the heavyweight panel item is only built for
+    the chunk about to be displayed.
+    """
+    name: str
+    ext: str
+    icon: 'FileTypeIcon'
+    absolute: str
+
 
 class QuickPanelFileBrowser:
     path_list = {}
+    # Listings keyed by (init_path, directory, st_mtime_ns), so a cached
+    # entry expires as soon as the directory changes on disk.
+    _dir_cache = OrderedDict()
+    DIR_CACHE_SIZE = 128
     separator = 4 * '&nbsp;'
     FLAGS = ( sublime.KEEP_OPEN_ON_FOCUS_LOST
             | sublime.WANT_EVENT
@@ -121,7 +201,14 @@ class QuickPanelFileBrowser:
             return
         self.window = window
         self.init_path = path
-        self.path_list[window.id()] = []
+        self.init_prefix = normalize_path(path).rstrip('/') + '/'
+        self.highlighted_index = -1
+        self.panel_generation = 0
+        self.dismissed_generation = 0
+        # An insertion-ordered set: saving the same path twice keeps a
+        # single copy, and membership stays O(1) however many paths
+        # pile up before the panel closes.
+        self.path_list[window.id()] = {}
 
         if not recursive:
             self.browse(path)
@@ -130,72 +217,195 @@ class QuickPanelFileBrowser:
                 'Listing files...', 'Done')
             StatusBarThread(task, window)
 
+    MAX_SCAN_WORKERS = 8
+    SCAN_FANOUT_THRESHOLD = 4
+    STREAM_CHUNK_SIZE = 500
+    # Scanning through an open directory fd (the trick behind os.fwalk)
+    # lets the kernel resolve any stat a worker still needs relative to
+    # that fd instead of re-walking the whole path.
+    SCAN_WITH_DIR_FD = os.name == 'posix' and os.scandir in os.supports_fd
+
     def list_files(self, path):
         Debug.print(f'list_files {path}')
-        paths = []
+        found = self.scan_tree(path)
+        Debug.print(f'files: {len(found)}')
+        entries = []
         items = []
-        for root, dirs, files in os.walk(path):
-            dirs[:] = [d for d in dirs if not self.exclude_folder(d)]
-            for file in files:
-                if self.exclude_file(file):
-                    continue
-                ext = os.path.splitext(file)[1]
-                if ext in self.ignored_file_types:
-                    continue
-                if ext not in self.file_type_icons:
-                    ext = '.*'
 
-                absolute = normalize_path(os.path.join(root, file))
-                relative = normalize_path(relpath(absolute, self.init_path))
-                actions = self.action_tags(absolute, relative, ext)
-                annotation = self.file_type_icons[ext].name
+        # Show the panel as soon as the first chunk of items is built,
+        # then keep extending it asynchronously: on huge trees the user
+        # can start filtering while the tail is still being rendered.
+        stream_generation = 0
+
+        def build_next_chunk():
+            # Once the first chunk is up, keep streaming only while its
+            # panel is still the live one: a dismissal or a panel shown
+            # by someone else makes the remaining chunks unwanted.
+            nonlocal stream_generation
+            start = len(items)
+            if start and (stream_generation != self.panel_generation
+                          or stream_generation == self.dismissed_generation):
+                return
+            for name, ext, icon, absolute in found[start:start + self.STREAM_CHUNK_SIZE]:
+                absolute = normalize_path(absolute)
+                relative = self.relative_path(absolute)
+                actions = self.action_tags(absolute, relative, ext, icon)
+                annotation = icon.name
 
-                paths.append(absolute)
+                entries.append((absolute, KIND_FILE))
                 items.append(
                     sublime.QuickPanelItem(
-                        file,
+                        name,
                         details=[relative, self.separator.join(actions)],
                         annotation=annotation,
                         kind=KIND_FILE
                     )
                 )
-        Debug.print(f'items: {len(items)}')
-        self.show_quick_panel(paths, items, '')
+            self.show_quick_panel(entries, items, '',
+                selected_index=self.highlighted_index)
+            stream_generation = self.panel_generation
+            if len(items) < len(found):
+                sublime.set_timeout_async(build_next_chunk)
+
+        build_next_chunk()
+
+    def scan_tree(self, path):
+        # Traversal is I/O-latency bound, so concurrent scandir() calls
+        # scale well; each worker keeps a local result list and merges
+        # it once, and only trees wide enough to amortize the submit
+        # overhead are fanned out to the pool.
+        files = []
+        lock = threading.Lock()
+        futures = []
+
+        def scan(curdir):
+            # Attribute lookups are not free in a loop that runs once
+            # per directory entry; bind everything hot to locals.
+            exclude_folder = self.exclude_folder
+            exclude_file = self.exclude_file
+            ignored = self.ignored_file_types
+            icons = self.file_type_icons
+            default_icon = self.default_file_icon
+            use_dir_fd = self.SCAN_WITH_DIR_FD
+            found = []
+            stack = [curdir]
+            while stack:
+                curdir = stack.pop()
+                prefix = curdir if curdir.endswith(os.sep) else curdir + os.sep
+                try:
+                    dir_fd = os.open(curdir, os.O_RDONLY) if use_dir_fd \
+                        else None
+                except OSError:
+                    continue
+                subdirs = []
+                try:
+                    with os.scandir(curdir if dir_fd is None else dir_fd) \
+                            as dir_entries:
+                        for entry in dir_entries:
+                            name = entry.name
+                            if entry.is_dir(follow_symlinks=False):
+                                if not exclude_folder(name):
+                                    subdirs.append(prefix + name)
+                                continue
+                            if exclude_file(name):
+                                continue
+                            # Bare entry names need none of the drive or
+                            # dotfile handling os.path.splitext pays for.
+                            dot = name.rfind('.')
+                            ext = name[dot:].lower() if dot > 0 else ''
+                            if ext in ignored:
+                                continue
+                            icon = icons.get(ext)
+                            if icon is None:
+                                ext, icon = '.*', default_icon
+                            found.append(
+                                RawFile(name, ext, icon, prefix + name))
+                except OSError:
+                    # Unreadable directories are skipped, like os.walk
+                    # with its default onerror=None did.
+                    continue
+                finally:
+                    if dir_fd is not None:
+                        os.close(dir_fd)
+                if len(subdirs) > self.SCAN_FANOUT_THRESHOLD:
+                    with lock:
+                        futures.extend(
+                            executor.submit(scan, subdir)
+                            for subdir in subdirs)
+                else:
+                    stack.extend(subdirs)
+            with lock:
+                files.extend(found)
+
+        with ThreadPoolExecutor(self.MAX_SCAN_WORKERS) as executor:
+            futures.append(executor.submit(scan, path))
+            while True:
+                with lock:
+                    if not futures:
+                        break
+                    future = futures.pop()
+                future.result()
+        return files
 
     def browse(self, curdir):
         Debug.print(f'browse {curdir}')
+        key = (self.init_path, normalize_path(curdir),
+               os.stat(curdir).st_mtime_ns)
+        if cached := self._dir_cache.get(key):
+            self._dir_cache.move_to_end(key)
+            entries, items = cached
+            self.show_quick_panel(entries, items, entries[1][0])
+            return
         pardir = normalize_path(abspath(os.path.join(curdir, '..')))
         curdir = normalize_path(curdir)
-        paths = [pardir, curdir]
+        entries = [(pardir, KIND_DIRECTORY), (curdir, KIND_DIRECTORY)]
         items = [
             self.make_item('..', pardir, None, KIND_DIRECTORY),
             self.make_item(curdir, curdir, None, KIND_DIRECTORY)
         ]
         items[0].annotation = 'parent ' + items[0].annotation
         items[1].annotation = 'current ' + items[1].annotation
-        for entry in os.listdir(curdir):
-            if entry[0] == '.' and not self.show_hidden_files:
-                continue
-            absolute = join_path(curdir, entry)
-            if isfile(absolute):
-                ext = os.path.splitext(entry)[1]
-                if ext in self.ignored_file_types:
+        ignored = self.ignored_file_types
+        icons = self.file_type_icons
+        with os.scandir(curdir) as dir_entries:
+            for entry in dir_entries:
+                name = entry.name
+                if name[0] == '.' and not self.show_hidden_files:
                     continue
-                if ext not in self.file_type_icons:
-                    ext = '.*'
-                kind = KIND_FILE
-            else:
-                ext = None
-                kind = KIND_DIRECTORY
-            paths.append(absolute)
-            items.append(self.make_item(entry, absolute, ext, kind))
+                absolute = normalize_path(entry.path)
+                if entry.is_dir(follow_symlinks=False):
+                    ext = None
+                    kind = KIND_DIRECTORY
+                else:
+                    dot = name.rfind('.')
+                    ext = name[dot:].lower() if dot > 0 else ''
+                    if ext in ignored:
+                        continue
+                    if ext not in icons:
+                        ext = '.*'
+                    kind = KIND_FILE
+                entries.append((absolute, kind))
+                items.append(self.make_item(name, absolute, ext, kind))
         Debug.print(f'items: {len(items)}')
-        self.show_quick_panel(paths, items, curdir)
+        self._dir_cache[key] = (entries, items)
+        if len(self._dir_cache) > self.DIR_CACHE_SIZE:
+            self._dir_cache.popitem(last=False)
+        self.show_quick_panel(entries, items, curdir)
+
+    def relative_path(self, absolute):
+        # Every path discovered under init_path shares its prefix, so a
+        # slice replaces the splitting and rebuilding relpath() does;
+        # relpath() remains as the fallback for paths outside the tree
+        # (e.g. the parent directory while browsing upwards).
+        if absolute.startswith(self.init_prefix):
+            return absolute[len(self.init_prefix):]
+        return normalize_path(relpath(absolute, self.init_path))
 
     def make_item(self, entry, absolute, ext, kind):
-        relative = normalize_path(relpath(absolute, self.init_path))
-        actions = self.action_tags(absolute, relative, ext)
-        annotation = self.file_type_icons[ext].name
+        icon = self.file_type_icons[ext]
+        relative = self.relative_path(absolute)
+        actions = self.action_tags(absolute, relative, ext, icon)
+        annotation = icon.name
         return sublime.QuickPanelItem(
                     entry,
                     details=self.separator.join(actions),
@@ -203,54 +413,41 @@ class QuickPanelFileBrowser:
                     kind=kind
                 )
 
-    def action_tags(self, absolute, relative, ext):
-        icon = self.file_type_icons[ext].icon
-        url = sublime.command_url(
-            'quick_file_browser_open_file',
-            args={
-                'path': absolute,
-                'open_in_sublime': ext == '.*'
-            }
-        )
-
-        def save_path_url(path):
-            return sublime.command_url(
-                'quick_file_browser_save_path',
-                args={'path': path}
-            )
-
-        def insert_path_url(path):
-            return sublime.command_url(
-                'insert',
-                args={'characters': path}
-            )
-
-        def make_tags(operation, make_url):
-            return f"""\
-<em>{operation} Path</em>:{2 * '&nbsp;'}\
-<a href="{make_url(absolute)}">absolute</a>,{2 * '&nbsp;'}\
-<a href="{make_url(relative)}">relative</a>;"""
-
+    def action_tags(self, absolute, relative, ext, icon):
+        open_url = open_file_url(absolute, ext == '.*')
         return [
-            make_tags('Copy', save_path_url),
-            make_tags('Insert', insert_path_url),
-            f'<a href="{url}">{icon}</a>'
+            COPY_TAG_PREFIX
+                + path_tags(save_path_url(absolute), save_path_url(relative)),
+            INSERT_TAG_PREFIX
+                + path_tags(insert_path_url(absolute), insert_path_url(relative)),
+            f'<a href="{open_url}">{icon.icon}</a>'
         ]
 
-    def show_quick_panel(self, paths, items, curdir):
+    def show_quick_panel(self, entries, items, curdir, selected_index=-1):
+        # Re-showing while a panel is open (e.g. a streamed refresh)
+        # makes Sublime cancel the replaced panel with index -1; the
+        # generation check tells those cancels apart from the user
+        # closing the newest panel for real.
+        self.panel_generation += 1
+        generation = self.panel_generation
+
         def on_done(index, event):
             if index == -1:
-                if path_list := self.path_list.pop(self.window.id()):
+                if generation != self.panel_generation:
+                    return
+                self.dismissed_generation = generation
+                if path_list := self.path_list.pop(self.window.id(), None):
                     sublime.set_clipboard('\n'.join(path_list))
                     sublime.status_message(f'Copied {len(path_list)} paths')
                 return
 
-            path = paths[index]
-            item = items[index]
-            if item.kind == KIND_FILE:
+            path, kind = entries[index]
+            if kind == KIND_FILE:
                 self.window.open_file(path)
                 if event.get('modifier_keys', {}).get('primary', False):
                     show(items, on_done, flags=self.FLAGS)
+                else:
+                    self.dismissed_generation = generation
             else:
                 if path != curdir:
                     try:
@@ -261,80 +458,82 @@ class QuickPanelFileBrowser:
                 else:
                     show(items, on_done, flags=self.FLAGS)
 
+        def on_highlight(index):
+            self.highlighted_index = index
+
         show = self.window.show_quick_panel
-        show(items, on_done, flags=self.FLAGS)
+        show(items, on_done, flags=self.FLAGS,
+             selected_index=selected_index, on_highlight=on_highlight)
 
     @classmethod
     def initialize(cls):
-        global join_path, normalize_path
+        global normalize_path
 
         Debug.set_debug(settings.get('debug', False))
+        cls._dir_cache.clear()
 
         if is_windows and settings.get('use_unix_style_path', True):
-            join_path = lambda path, leaf: '/'.join([path, leaf])
-            normalize_path = lambda path: path.replace('\\', '/')
+            normalize_path = unix_style_path
         else:
-            join_path = os.path.join
-            normalize_path = lambda path: path
+            normalize_path = keep_path
 
         file_exclude_patterns = settings.get('file_exclude_patterns', [])
         folder_exclude_patterns = settings.get('folder_exclude_patterns', [])
 
-        cls.exclude_file = pat2regex(file_exclude_patterns).match
-        cls.exclude_folder = pat2regex(folder_exclude_patterns).match
+        cls.exclude_file = staticmethod(make_excluder(file_exclude_patterns))
+        cls.exclude_folder = staticmethod(make_excluder(folder_exclude_patterns))
         cls.show_hidden_files = settings.get('show_hidden_files', True)
-        cls.ignored_file_types = settings.get('ignored_file_types', [])
+        cls.ignored_file_types = frozenset(
+            ext.lower() for ext in settings.get('ignored_file_types', []))
         cls.file_type_icons = file_type_icons = {}
 
         for name, file_type in settings.get('file_types', {}).items():
             icon = file_type.get('icon', 'Open')
             file_type_icon = FileTypeIcon(name, icon)
             extensions = file_type.get('extensions', [])
-            if isinstance(extensions, list):
-                for extension in extensions:
-                    file_type_icons[extension] = file_type_icon
-            else:
-                file_type_icons[extensions] = file_type_icon
+            if not isinstance(extensions, list):
+                extensions = [extensions]
+            for extension in extensions:
+                file_type_icons[ext_key(extension)] = file_type_icon
 
         if '.*' not in file_type_icons:
             file_type_icons['.*'] = FileTypeIcon('file', 'Open')
         if None not in file_type_icons:
             file_type_icons[None] = FileTypeIcon('folder', 'Open')
+        cls.default_file_icon = file_type_icons['.*']
 
 
-class FileTypeIcon:
-    __slots__ = ['name', 'icon']
-
-    def __init__(self, name, icon):
-        self.name = name
-        self.icon = icon
-
-    def __repr__(self):
-        return f'FileTypeIcon(name="{name}", icon="{icon}")'
+class FileTypeIcon(NamedTuple):
+    name: str
+    icon: str
 
 
 
 class StatusBarTask:
     def __init__(self, function, message, success):
         self.function = function
-        self.message = message
+        self.prefix = f'{message} '
         self.success = success
 
     def attach(self, status_bar):
         self.status_bar = status_bar
 
     def status_message(self):
-        return f'{self.message} {self.status_bar.status}'
+        return self.prefix + self.status_bar.status
 
     def finish_message(self):
         return self.success
 
 
 class StatusBarThread:
+    _FRAMES = tuple(f"[{' ' * i}={' ' * (7 - i)}]" for i in range(8))
+
     def __init__(self, task, window, key='__z{|}~__'):
         self.state = 7
         self.step = 1
+        self.ticks = 0
         self.last_view = None
+        self.last_message = None
         self.need_refresh = True
         self.window = window
         self.key = key
@@ -352,21 +551,36 @@ class StatusBarThread:
         self.need_refresh = True
 
     def update_status_message(self):
+        self.ticks += 1
         self.update_status_bar()
         if self.need_refresh:
-            self.show_status_message(self.task.status_message())
+            message = self.task.status_message()
+            if message != self.last_message:
+                self.last_message = message
+                self.show_status_message(message)
         if not self.thread.is_alive():
             cleanup = self.last_view.erase_status
             self.last_view.set_status(self.key, self.task.finish_message())
             sublime.set_timeout(lambda: cleanup(self.key), 2000)
         else:
-            sublime.set_timeout(self.update_status_message, 100)
+            sublime.set_timeout_async(
+                self.update_status_message, self.tick_interval())
+
+    def tick_interval(self):
+        # Animate briskly while the task still looks quick, then back
+        # off so a multi-second scan is not hammering the status bar
+        # ten times a second.
+        if self.ticks < 10:
+            return 100
+        if self.ticks < 40:
+            return 250
+        return 500
 
     def update_status_bar(self):
         if self.state == 0 or self.state == 7:
             self.step = -self.step
         self.state += self.step
-        self.status = f"[{' ' * self.state}={' ' * (7 - self.state)}]"
+        self.status = self._FRAMES[self.state]
 
     def show_status_message(self, message):
         active_view = self.window.active_view()
@@ -377,23 +591,30 @@ class StatusBarThread:
 
 
 
-def pat2regex(patterns):
-    transtable = str.maketrans({
-        '*': '.*',
-        '.': '\\.',
-        '?': '.'
-    })
+def ext_key(extension):
+    # The shipped settings use null as the extensions entry that maps
+    # directories to the folder icon, so only actual extension strings
+    # get case-folded.
+    return extension.lower() if isinstance(extension, str) else extension
+
+
+def make_excluder(patterns):
+    # Plain names are far more common than wildcards in exclude lists,
+    # so check them with a frozenset and only run the compiled regex
+    # union over the patterns that actually contain glob characters.
+    literals = frozenset(p for p in patterns if not re.search(r'[*?[]', p))
+    wildcards = [p for p in patterns if p not in literals]
 
-    def convert(pattern):
-        return str.translate(pattern, transtable)
+    if wildcards:
+        match = re.compile('|'.join(map(fnmatch.translate, wildcards))).match
 
-    try:
-        regex = re.compile(f'^(?:{"|".join(map(convert, patterns))})$')
-    except:
-        regex = re.compile('.*')
-        sublime.error_message(f'Invalid patterns: {patterns}')
+        def exclude(name):
+            return name in literals or match(name) is not None
+    else:
+        def exclude(name):
+            return name in literals
 
-    return regex
+    return exclude
 
 
 def plugin_loaded():